@@ -5,19 +5,36 @@ Allows calling the stage 1 generation as a function instead of CLI
 
 import sys
 import os
-import yaml
+import json
 import shutil
-from typing import Dict, Optional
+import asyncio
+from typing import Dict, List, Optional
 
 sys.path.append("../")
 
 import utils.gpt as gpt
-from utils.util import save, save_svg
-import torch
-import clip
-import ImageReward as RM
-import glob
-from PIL import Image
+from utils.pipeline import run_pipeline
+from utils.reward_cache import get_model, image_reward_scores, clip_scores, LRUCache
+from aiolimiter import AsyncLimiter
+
+
+class LLMLimiter:
+    """
+    Async context manager bounding in-flight LLM requests and,
+    optionally, the request rate against the provider
+    """
+
+    def __init__(self, max_concurrency: int = 4, requests_per_minute: Optional[int] = None):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate = AsyncLimiter(requests_per_minute, 60) if requests_per_minute else None
+
+    async def __aenter__(self):
+        if self.rate is not None:
+            await self.rate.acquire()
+        await self.semaphore.acquire()
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
 
 
 class TemplateGenerator:
@@ -25,16 +42,82 @@ class TemplateGenerator:
     Class to handle SVG template generation with a functional API
     """
     
-    def __init__(self, output_base_path: str = "../output"):
+    def __init__(
+        self,
+        output_base_path: str = "../output",
+        max_concurrency: int = 4,
+        requests_per_minute: Optional[int] = None
+    ):
         """
         Initialize the template generator
         
         Args:
             output_base_path: Base path for output files
+            max_concurrency: Maximum number of LLM requests in flight at once
+            requests_per_minute: Optional provider rate limit for LLM requests
         """
         self.output_base_path = output_base_path
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        # Normalized CLIP text features of recent prompts, keyed by (CLIP model, prompt)
+        self._text_feat_cache = LRUCache(maxsize=32)
         
-    def generate(
+    def generate(self, *args, **kwargs) -> Dict:
+        """
+        Generate SVG template from text prompt (blocking)
+
+        Accepts the same arguments as `agenerate`.
+        """
+        return asyncio.run(self.agenerate(*args, **kwargs))
+
+    def generate_many(self, targets: List[Dict]) -> List[Dict]:
+        """
+        Generate SVG templates for several targets concurrently
+
+        Args:
+            targets: List of keyword-argument dicts accepted by `agenerate`
+
+        Returns:
+            List of result dictionaries, in the same order as `targets`
+        """
+        async def run_all():
+            limiter = LLMLimiter(self.max_concurrency, self.requests_per_minute)
+            return await asyncio.gather(
+                *[self.agenerate(**t, limiter=limiter) for t in targets]
+            )
+
+        return asyncio.run(run_all())
+
+    def generate_batch(
+        self,
+        targets: List[Dict],
+        collect_window: float = 2.0,
+        poll_interval: float = 30.0
+    ) -> List[Dict]:
+        """
+        Generate SVG templates for several targets through the Message Batches API
+
+        Every pipeline step of all targets is submitted as one batch, which
+        halves the LLM cost at the price of latency (batches may take minutes
+        to hours). Only available with the Claude backend.
+
+        Args:
+            targets: List of keyword-argument dicts accepted by `agenerate`
+            collect_window: Seconds without new requests before a batch is sent
+            poll_interval: Seconds between batch status checks
+
+        Returns:
+            List of result dictionaries, in the same order as `targets`
+        """
+        async def run_all():
+            batcher = gpt.MessageBatcher(collect_window, poll_interval)
+            return await asyncio.gather(
+                *[self.agenerate(**t, batcher=batcher) for t in targets]
+            )
+
+        return asyncio.run(run_all())
+
+    async def agenerate(
         self,
         target: str,
         prompt: str,
@@ -43,7 +126,10 @@ class TemplateGenerator:
         refine_iter: int = 2,
         model: str = "claude-3-5-sonnet-20240620",
         reward_model: str = "ImageReward",
-        prompts_file: str = "prompts"
+        prompts_file: str = "prompts",
+        parallel_candidates: bool = False,
+        limiter: Optional[LLMLimiter] = None,
+        batcher: Optional[gpt.MessageBatcher] = None
     ) -> Dict:
         """
         Generate SVG template from text prompt
@@ -57,6 +143,11 @@ class TemplateGenerator:
             model: LLM model to use
             reward_model: Model for ranking ("ImageReward" or "CLIP")
             prompts_file: Prompts configuration file
+            parallel_candidates: Generate `refine_iter + 1` independent candidates
+                concurrently instead of refining each one from the previous render
+            limiter: Optional limiter shared by concurrent generations
+            batcher: Optional message batcher; LLM requests are then queued
+                into provider-side batches instead of being sent directly
             
         Returns:
             Dictionary with generation results including paths and metadata
@@ -74,6 +165,7 @@ class TemplateGenerator:
         cfg.model = model
         cfg.reward_model = reward_model
         cfg.prompts_file = prompts_file
+        cfg.parallel_candidates = parallel_candidates
         
         # Set up output directories
         if output_folder is None:
@@ -89,8 +181,8 @@ class TemplateGenerator:
             os.makedirs(dir_p, exist_ok=True)
         
         # Save config
-        with open(f"{cfg.output_folder}/config.yaml", "w", encoding="utf-8") as f:
-            yaml.dump(cfg.__dict__, f)
+        with open(f"{cfg.output_folder}/config.json", "w", encoding="utf-8") as f:
+            json.dump(cfg.__dict__, f, indent=2, default=str)
         
         # Save prompts file
         prompts_source = f"../{prompts_file}.yaml"
@@ -98,48 +190,49 @@ class TemplateGenerator:
             shutil.copyfile(prompts_source, f"{cfg.output_folder}/prompts.yaml")
         
         # Execute generation
-        result = self._execute_generation(cfg)
+        # Batched requests are queued, not sent, so they are not rate limited
+        if limiter is None and batcher is None:
+            limiter = LLMLimiter(self.max_concurrency, self.requests_per_minute)
+        result = await self._execute_generation(cfg, limiter, batcher)
         
         return result
     
-    def _execute_generation(self, cfg) -> Dict:
+    async def _execute_generation(self, cfg, limiter=None, batcher=None) -> Dict:
         """
         Execute the actual SVG generation process
         
         Args:
             cfg: Configuration object
+            limiter: Optional limiter bounding concurrent LLM requests
+            batcher: Optional message batcher used by the session
             
         Returns:
             Dictionary with results
         """
         session = gpt.Session(model=cfg.model, prompts_file=cfg.prompts_file)
-        msg_path = lambda i: f"{cfg.msg_dir}/{cfg.target}_raw{i}"
-        
-        # Task 1: Expand the Text Prompt
-        expanded_text_prompt = session.send(
-            "expand_text_prompt",
-            {"text_prompt": cfg.prompt},
-            file_path=f"{cfg.msg_dir}/{cfg.target}_prompt",
-        )
-        save(f"{cfg.msg_dir}/{cfg.target}_prompt", expanded_text_prompt)
-        
-        # Task 2: Generate SVG Code
-        svg_code = session.send("write_svg_code", file_path=msg_path(0))
-        save(msg_path(0), svg_code)
-        save_svg(cfg, svg_code, f"{cfg.target}_0")
-        svg_path = f"{cfg.svg_dir}/{cfg.target}_0.svg"
-        png_path = f"{cfg.png_dir}/{cfg.target}_0.png"
+        session.batcher = batcher
+        try:
+            return await self._generate(cfg, session, limiter)
+        finally:
+            await session.aclose()
+    
+    async def _generate(self, cfg, session, limiter=None) -> Dict:
+        """
+        Run the generation tasks on an open session
         
-        # Task 3: Iterate Improvement
-        for i in range(1, cfg.refine_iter + 1):
-            svg_code = session.send("svg_refine", images=[png_path], file_path=msg_path(i))
-            save(msg_path(i), svg_code)
-            save_svg(cfg, svg_code, f"{cfg.target}_{i}")
-            svg_path = f"{cfg.svg_dir}/{cfg.target}_{i}.svg"
-            png_path = f"{cfg.png_dir}/{cfg.target}_{i}.png"
+        Args:
+            cfg: Configuration object
+            session: LLM session used for all tasks
+            limiter: Optional limiter bounding concurrent LLM requests
+            
+        Returns:
+            Dictionary with results
+        """
+        expanded_text_prompt, iterations = await run_pipeline(cfg, session, limiter)
         
-        # Automatically select the best SVG
-        best_index = self._select_best_svg(cfg)
+        # Automatically select the best SVG; ranking runs in a worker thread
+        # so the LLM requests of concurrent targets keep flowing meanwhile
+        best_index = await asyncio.to_thread(self._select_best_svg, cfg, iterations)
         
         result = {
             "success": True,
@@ -150,17 +243,44 @@ class TemplateGenerator:
             "svg_dir": cfg.svg_dir,
             "png_dir": cfg.png_dir,
             "expanded_prompt": expanded_text_prompt,
+            "iterations": iterations,
             "total_iterations": cfg.refine_iter + 1
         }
         
         return result
     
-    def _select_best_svg(self, cfg) -> int:
+    def _rank_candidates(self, model_name: str, prompt: str, png_files: List[str]) -> int:
+        """
+        Rank the rendered candidates with the reward model
+        
+        Args:
+            model_name: "ImageReward" or "CLIP"
+            prompt: Text prompt the candidates should match
+            png_files: Candidate renders, in iteration order
+            
+        Returns:
+            Index of the best candidate
+        """
+        # torch is only imported once ranking actually starts; the models are
+        # cached for the lifetime of the process
+        import torch
+        
+        with torch.inference_mode():
+            if model_name == "ImageReward":
+                scores = image_reward_scores(get_model("ImageReward"), prompt, png_files)
+            else:  # CLIP
+                scores = clip_scores(*get_model("CLIP"), prompt, png_files, self._text_feat_cache)
+        best_index = scores.argmax().item()
+        
+        return best_index
+    
+    def _select_best_svg(self, cfg, iterations: List[Dict]) -> int:
         """
         Select the best SVG using reward model
         
         Args:
             cfg: Configuration object
+            iterations: Iteration dicts returned by `run_pipeline`
             
         Returns:
             Index of the best SVG
@@ -171,47 +291,20 @@ class TemplateGenerator:
             "CLIP",
         ], "Only `ImageReward` and `CLIP` are supported"
         
-        # Load appropriate model
-        if model_name == "ImageReward":
-            model = RM.load("ImageReward-v1.0")
-        else:  # CLIP
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            model, preprocess = clip.load("ViT-B/32", device=device)
-        
-        png_files = sorted(glob.glob(f"{cfg.png_dir}/*.png"))
-        prompt = cfg.prompt
-        
-        # Get ranking based on selected model
-        with torch.no_grad():
-            if model_name == "ImageReward":
-                ranking, _ = model.inference_rank(prompt, png_files)
-                best_index = ranking[0] - 1  # ImageReward uses 1-based indexing
-            else:  # CLIP
-                device = next(model.parameters()).device
-                
-                images = torch.cat([
-                    preprocess(Image.open(png_file)).unsqueeze(0)
-                    for png_file in png_files
-                ]).to(device)
-                text = clip.tokenize([prompt]).to(device)
-                
-                image_features = model.encode_image(images)
-                text_features = model.encode_text(text)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-                text_features /= text_features.norm(dim=-1, keepdim=True)
-                
-                similarity = (100.0 * image_features @ text_features.T).squeeze()
-                best_index = similarity.argmax().item()
+        # Rank only this run's candidates, not leftovers of earlier runs in png_dir
+        png_files = [it["png_path"] for it in iterations]
+        if len(png_files) <= 1:
+            # A single candidate needs no ranking, so skip loading the reward model
+            best = 0
+        else:
+            best = self._rank_candidates(model_name, cfg.prompt, png_files)
         
         # Copy the best SVG to the root directory
-        best_svg = f"{cfg.target}_{best_index}.svg"
-        print(f"The best SVG is: {best_svg}")
-        shutil.copy(
-            f"{cfg.svg_dir}/{best_svg}",
-            f"{cfg.root_dir}/{cfg.target}_template.svg"
-        )
+        best_svg_path = iterations[best]["svg_path"]
+        print(f"The best SVG is: {os.path.basename(best_svg_path)}")
+        shutil.copy(best_svg_path, f"{cfg.root_dir}/{cfg.target}_template.svg")
         
-        return best_index
+        return iterations[best]["iteration"]
 
 
 def generate_template(
@@ -223,7 +316,8 @@ def generate_template(
     model: str = "claude-3-5-sonnet-20240620",
     reward_model: str = "ImageReward",
     output_base_path: str = "../output",
-    prompts_file: str = "prompts"
+    prompts_file: str = "prompts",
+    parallel_candidates: bool = False
 ) -> Dict:
     """
     Convenience function to generate SVG template
@@ -238,6 +332,7 @@ def generate_template(
         reward_model: Ranking model ("ImageReward" or "CLIP")
         output_base_path: Base path for outputs
         prompts_file: Prompts configuration file
+        parallel_candidates: Generate independent candidates concurrently
         
     Returns:
         Dictionary with generation results
@@ -251,7 +346,8 @@ def generate_template(
         refine_iter=refine_iter,
         model=model,
         reward_model=reward_model,
-        prompts_file=prompts_file
+        prompts_file=prompts_file,
+        parallel_candidates=parallel_candidates
     )
 
 
@@ -8,7 +8,8 @@ import os
 import sys
 import tempfile
 import shutil
-import base64
+import pybase64
+import asyncio
 from pathlib import Path
 import yaml
 
@@ -16,12 +17,10 @@ import yaml
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import utils.gpt as gpt
-from utils.util import save, save_svg, extract_svg
+from utils.pipeline import run_pipeline
+from utils.reward_cache import get_model, image_reward_scores, clip_scores, LRUCache
+from runpod_config import RunPodConfig, format_validation_error
 import torch
-import clip
-import ImageReward as RM
-import glob
-from PIL import Image
 
 
 class SVGGenerator:
@@ -32,6 +31,8 @@ class SVGGenerator:
         self.session = None
         self.reward_model = None
         self.reward_model_name = None
+        # Normalized CLIP text features of recent prompts, keyed by (CLIP model, prompt)
+        self._text_feat_cache = LRUCache(maxsize=32)
         
     def initialize_session(self, model: str, prompts_file: str = "prompts"):
         """Initialize GPT session"""
@@ -42,47 +43,41 @@ class SVGGenerator:
         """Initialize reward model for ranking"""
         if self.reward_model is None or self.reward_model_name != model_name:
             if model_name == "ImageReward":
-                self.reward_model = RM.load("ImageReward-v1.0")
+                self.reward_model = get_model("ImageReward")
             else:  # CLIP
-                device = "cuda" if torch.cuda.is_available() else "cpu"
-                self.reward_model, self.preprocess = clip.load("ViT-B/32", device=device)
+                self.reward_model, self.preprocess = get_model("CLIP")
+                # The worker is long-lived, so compile the image tower once and let
+                # later requests reuse the captured CUDA graphs
+                if torch.cuda.is_available() and not getattr(self.reward_model, "_visual_compiled", False):
+                    self.reward_model.visual = torch.compile(
+                        self.reward_model.visual, mode="reduce-overhead", fullgraph=False
+                    )
+                    self.reward_model._visual_compiled = True
             self.reward_model_name = model_name
     
-    def select_best_svg(self, svg_dir: str, png_dir: str, prompt: str, target: str, model_name: str = "ImageReward"):
-        """Select the best SVG based on reward model"""
-        self.initialize_reward_model(model_name)
-        
-        png_files = sorted(glob.glob(f"{png_dir}/*.png"))
+    def select_best_svg(self, iterations: list[dict], prompt: str, model_name: str = "ImageReward"):
+        """Select the best of the iterations returned by `run_pipeline` based on reward model"""
+        png_files = [it["png_path"] for it in iterations]
         
         if not png_files:
             raise ValueError("No PNG files found for ranking")
+        if len(png_files) == 1:
+            # A single candidate needs no ranking, so skip loading the reward model
+            return iterations[0]
+        
+        self.initialize_reward_model(model_name)
         
         # Get ranking based on selected model
-        with torch.no_grad():
+        with torch.inference_mode():
             if model_name == "ImageReward":
-                ranking, _ = self.reward_model.inference_rank(prompt, png_files)
-                best_index = ranking[0] - 1
+                scores = image_reward_scores(self.reward_model, prompt, png_files)
             else:  # CLIP
-                device = next(self.reward_model.parameters()).device
-                
-                images = torch.cat([
-                    self.preprocess(Image.open(png_file)).unsqueeze(0)
-                    for png_file in png_files
-                ]).to(device)
-                text = clip.tokenize([prompt]).to(device)
-                
-                image_features = self.reward_model.encode_image(images)
-                text_features = self.reward_model.encode_text(text)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-                text_features /= text_features.norm(dim=-1, keepdim=True)
-                
-                similarity = (100.0 * image_features @ text_features.T).squeeze()
-                best_index = similarity.argmax().item()
-        
-        best_svg_path = f"{svg_dir}/{target}_{best_index}.svg"
-        return best_svg_path, best_index
+                scores = clip_scores(
+                    self.reward_model, self.preprocess, prompt, png_files, self._text_feat_cache
+                )
+        return iterations[scores.argmax().item()]
     
-    def generate_svg(
+    async def generate_svg(
         self,
         prompt: str,
         target: str = "generated",
@@ -90,7 +85,8 @@ class SVGGenerator:
         refine_iter: int = 2,
         model: str = "claude-3-5-sonnet-20240620",
         reward_model: str = "ImageReward",
-        prompts_file: str = "prompts"
+        prompts_file: str = "prompts",
+        parallel_candidates: bool = False
     ):
         """
         Generate SVG template from text prompt
@@ -103,6 +99,8 @@ class SVGGenerator:
             model: LLM model to use (default: claude-3-5-sonnet-20240620)
             reward_model: Reward model for selection (ImageReward or CLIP)
             prompts_file: Prompts file to use (default: prompts)
+            parallel_candidates: Generate independent candidates concurrently
+                instead of refining each one from the previous render
             
         Returns:
             dict with SVG content and metadata
@@ -127,6 +125,7 @@ class SVGGenerator:
                     self.refine_iter = refine_iter
                     self.model = model
                     self.reward_model = reward_model
+                    self.parallel_candidates = parallel_candidates
                     self.svg_dir = svg_dir
                     self.png_dir = png_dir
                     self.msg_dir = msg_dir
@@ -136,55 +135,35 @@ class SVGGenerator:
             # Initialize session
             self.initialize_session(model, prompts_file)
             
-            msg_path = lambda i: f"{msg_dir}/{target}_raw{i}"
-            
-            # Task 1: Expand the text prompt
-            print(f"Expanding prompt: {prompt}")
-            expanded_text_prompt = self.session.send(
-                "expand_text_prompt",
-                {"text_prompt": prompt},
-                file_path=f"{msg_dir}/{target}_prompt",
-            )
-            save(f"{msg_dir}/{target}_prompt", expanded_text_prompt)
-            
-            # Task 2: Generate initial SVG code
-            print("Generating initial SVG...")
-            svg_code = self.session.send("write_svg_code", file_path=msg_path(0))
-            save(msg_path(0), svg_code)
-            save_svg(cfg, svg_code, f"{target}_0")
-            png_path = f"{png_dir}/{target}_0.png"
-            
-            # Task 3: Iterate improvements
-            for i in range(1, refine_iter + 1):
-                print(f"Refining SVG iteration {i}/{refine_iter}...")
-                svg_code = self.session.send("svg_refine", images=[png_path], file_path=msg_path(i))
-                save(msg_path(i), svg_code)
-                save_svg(cfg, svg_code, f"{target}_{i}")
-                png_path = f"{png_dir}/{target}_{i}.png"
+            try:
+                expanded_text_prompt, iterations = await run_pipeline(cfg, self.session)
+            finally:
+                await self.session.aclose()
             
             # Select best SVG
             print(f"Selecting best SVG using {reward_model}...")
-            best_svg_path, best_index = self.select_best_svg(
-                svg_dir, png_dir, prompt, target, reward_model
+            # Ranking (and the first CLIP compile) runs in a worker thread so
+            # the RunPod worker's event loop is not blocked meanwhile
+            best = await asyncio.to_thread(
+                self.select_best_svg, iterations, prompt, reward_model
             )
+            best_index = best["iteration"]
             
             # Read the best SVG
-            with open(best_svg_path, 'r') as f:
+            with open(best["svg_path"], 'r') as f:
                 best_svg_content = f.read()
             
-            # Read the best PNG and encode to base64
-            best_png_path = f"{png_dir}/{target}_{best_index}.png"
-            with open(best_png_path, 'rb') as f:
-                best_png_base64 = base64.b64encode(f.read()).decode('utf-8')
+            # Read the best PNG and encode to base64 (SIMD-accelerated)
+            with open(best["png_path"], 'rb') as f:
+                best_png_base64 = pybase64.b64encode(f.read()).decode('ascii')
             
             # Collect all SVG iterations
             all_svgs = []
-            for i in range(refine_iter + 1):
-                svg_path = f"{svg_dir}/{target}_{i}.svg"
-                if os.path.exists(svg_path):
-                    with open(svg_path, 'r') as f:
+            for it in iterations:
+                if os.path.exists(it["svg_path"]):
+                    with open(it["svg_path"], 'r') as f:
                         all_svgs.append({
-                            "iteration": i,
+                            "iteration": it["iteration"],
                             "svg_content": f.read()
                         })
             
@@ -210,9 +189,9 @@ class SVGGenerator:
 generator = SVGGenerator()
 
 
-def handler(event):
+async def handler(event):
     """
-    RunPod handler function
+    RunPod handler function (awaited by the RunPod worker's event loop)
     
     Expected input format:
     {
@@ -223,7 +202,8 @@ def handler(event):
             "refine_iter": 2,  # Optional, default: 2
             "model": "claude-3-5-sonnet-20240620",  # Optional
             "reward_model": "ImageReward",  # Optional: "ImageReward" or "CLIP"
-            "prompts_file": "prompts"  # Optional, default: "prompts"
+            "prompts_file": "prompts",  # Optional, default: "prompts"
+            "parallel_candidates": False  # Optional, default: False
         }
     }
     
@@ -241,37 +221,31 @@ def handler(event):
         # Extract input parameters
         job_input = event.get("input", {})
         
-        # Validate required parameters
-        if "prompt" not in job_input:
-            return {
-                "error": "Missing required parameter: prompt",
-                "success": False
-            }
-        
-        prompt = job_input["prompt"]
-        target = job_input.get("target", "generated")
-        viewbox = job_input.get("viewbox", 512)
-        refine_iter = job_input.get("refine_iter", 2)
-        model = job_input.get("model", "claude-3-5-sonnet-20240620")
-        reward_model = job_input.get("reward_model", "ImageReward")
-        prompts_file = job_input.get("prompts_file", "prompts")
-        
         # Validate parameters
-        if reward_model not in ["ImageReward", "CLIP"]:
-            return {
-                "error": f"Invalid reward_model: {reward_model}. Must be 'ImageReward' or 'CLIP'",
-                "success": False
-            }
+        is_valid, error = RunPodConfig.validate_input(job_input)
+        if not is_valid:
+            return format_validation_error(error)
+        
+        params = RunPodConfig.merge_with_defaults(job_input)
+        prompt = params["prompt"]
+        target = params["target"]
+        viewbox = params["viewbox"]
+        refine_iter = params["refine_iter"]
+        model = params["model"]
+        reward_model = params["reward_model"]
+        prompts_file = params["prompts_file"]
+        parallel_candidates = params["parallel_candidates"]
         
         # Generate SVG
-        result = generator.generate_svg(
+        result = await generator.generate_svg(
             prompt=prompt,
             target=target,
             viewbox=viewbox,
             refine_iter=refine_iter,
             model=model,
             reward_model=reward_model,
-            prompts_file=prompts_file
+            prompts_file=prompts_file,
+            parallel_candidates=parallel_candidates
         )
         
         return result
@@ -288,4 +262,9 @@ def handler(event):
 if __name__ == "__main__":
     # Start the RunPod serverless worker
     print("Starting RunPod serverless worker for Chat2SVG Stage 1...")
+    # Load the reward models once per container instead of on the first request
+    if RunPodConfig.PRELOAD_REWARD_MODEL:
+        get_model("ImageReward")
+    if RunPodConfig.PRELOAD_CLIP_MODEL:
+        get_model("CLIP")
     runpod.serverless.start({"handler": handler})
@@ -1,15 +1,20 @@
-import sys, os, argparse, yaml, shutil
+import sys, os, argparse, json, shutil, asyncio
 
 sys.path.append("../")
 
 import utils.gpt as gpt
-from utils.util import save, get_prompt, save_svg
+from utils.util import get_prompt
+from utils.pipeline import run_pipeline
+from utils.reward_cache import (
+    get_model,
+    image_reward_scores,
+    clip_scores,
+    release_model,
+    LRUCache,
+)
 
-import torch
-import clip
-import ImageReward as RM
-import glob
-from PIL import Image
+# Normalized CLIP text features of recent prompts, keyed by (CLIP model, prompt)
+_text_feat_cache = LRUCache(maxsize=32)
 
 
 def parse_arguments():
@@ -25,6 +30,11 @@ def parse_arguments():
     parser.add_argument("--refine_iter", type=int, default=2)
     parser.add_argument("--model", type=str, default="claude-3-5-sonnet-20240620")
     parser.add_argument("--reward_model", type=str, default="ImageReward")
+    parser.add_argument(
+        "--parallel_candidates",
+        action="store_true",
+        help="generate independent candidates concurrently instead of refining",
+    )
     args = parser.parse_args()
 
     args.prompt = get_prompt(args.target)
@@ -40,8 +50,8 @@ def parse_arguments():
     args.prompts_file = "prompts"
 
     # Save config
-    with open(f"{args.output_folder}/config.yaml", "w", encoding="utf-8") as f:
-        yaml.dump(args.__dict__, f)
+    with open(f"{args.output_folder}/config.json", "w", encoding="utf-8") as f:
+        json.dump(args.__dict__, f, indent=2, default=str)
     # Save prompts file
     shutil.copyfile(
         f"../{args.prompts_file}.yaml", f"{args.output_folder}/prompts.yaml"
@@ -50,90 +60,61 @@ def parse_arguments():
     return args
 
 
-def select_best_svg(cfgs, model_name="ImageReward"):
+def rank_candidates(model_name, prompt, png_files):
+    # torch is only imported once ranking actually starts; the models are
+    # cached for the lifetime of the process
+    import torch
+
+    with torch.inference_mode():
+        if model_name == "ImageReward":
+            scores = image_reward_scores(get_model("ImageReward"), prompt, png_files)
+        else:  # CLIP
+            scores = clip_scores(
+                *get_model("CLIP"), prompt, png_files, _text_feat_cache
+            )
+    best_index = scores.argmax().item()
+
+    return best_index
+
+
+def select_best_svg(cfgs, iterations, model_name="ImageReward", persist=False):
     assert model_name in [
         "ImageReward",
         "CLIP",
     ], "Only `ImageReward` and `CLIP` are supported"
 
-    # Load appropriate model
-    if model_name == "ImageReward":
-        model = RM.load("ImageReward-v1.0")
-    else:  # CLIP
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model, preprocess = clip.load("ViT-B/32", device=device)
-
-    png_files = sorted(glob.glob(f"{cfgs.png_dir}/*.png"))
-    prompt = cfgs.prompt
-
-    # Get ranking based on selected model
-    with torch.no_grad():
-        if model_name == "ImageReward":
-            ranking, _ = model.inference_rank(prompt, png_files)
-            best_index = ranking[0] - 1  # ImageReward uses 1-based indexing
-        else:  # CLIP
-            device = next(model.parameters()).device  # Get device from model
-
-            # Process images and text
-            images = torch.cat(
-                [
-                    preprocess(Image.open(png_file)).unsqueeze(0)
-                    for png_file in png_files
-                ]
-            ).to(device)
-            text = clip.tokenize([prompt]).to(device)
-
-            # Compute normalized features and similarity
-            image_features = model.encode_image(images)
-            text_features = model.encode_text(text)
-            image_features /= image_features.norm(dim=-1, keepdim=True)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-
-            # Get ranking
-            similarity = (100.0 * image_features @ text_features.T).squeeze()
-            best_index = similarity.argmax().item()
+    # Rank only this run's candidates, not leftovers of earlier runs in png_dir
+    png_files = [it["png_path"] for it in iterations]
+    if len(png_files) <= 1:
+        # A single candidate needs no ranking, so skip loading the reward model
+        best_index = 0
+    else:
+        try:
+            best_index = rank_candidates(model_name, cfgs.prompt, png_files)
+        finally:
+            if not persist:
+                # One-shot run: free the GPU before later stages load their models
+                release_model(model_name)
 
     # Copy the best SVG to the root directory
-    best_svg = f"{cfgs.target}_{best_index}.svg"
-    print(f"The best SVG is: {best_svg}")
-    shutil.copy(
-        f"{cfgs.svg_dir}/{best_svg}", f"{cfgs.root_dir}/{cfgs.target}_template.svg"
-    )
+    best_svg_path = iterations[best_index]["svg_path"]
+    print(f"The best SVG is: {os.path.basename(best_svg_path)}")
+    shutil.copy(best_svg_path, f"{cfgs.root_dir}/{cfgs.target}_template.svg")
 
 
-def main(cfgs):
+async def main(cfgs):
     session = gpt.Session(model=cfgs.model, prompts_file=cfgs.prompts_file)
-    msg_path = lambda i: f"{cfgs.msg_dir}/{cfgs.target}_raw{i}"
-
-    # Task 1: Expand the Text Prompt
-    expanded_text_prompt = session.send(
-        "expand_text_prompt",
-        {"text_prompt": cfgs.prompt},
-        file_path=f"{cfgs.msg_dir}/{cfgs.target}_prompt",
-    )
-    save(f"{cfgs.msg_dir}/{cfgs.target}_prompt", expanded_text_prompt)
-
-    # Task 2: Generate SVG Code
-    svg_code = session.send("write_svg_code", file_path=msg_path(0))
-    save(msg_path(0), svg_code)
-    save_svg(cfgs, svg_code, f"{cfgs.target}_0")
-    _ = f"{cfgs.svg_dir}/{cfgs.target}_0.svg"
-    png_path = f"{cfgs.png_dir}/{cfgs.target}_0.png"
-
-    # Task 3: Iterate Improvement
-    for i in range(1, cfgs.refine_iter + 1):
-        svg_code = session.send("svg_refine", images=[png_path], file_path=msg_path(i))
-        save(msg_path(i), svg_code)
-        save_svg(cfgs, svg_code, f"{cfgs.target}_{i}")
-        _ = f"{cfgs.svg_dir}/{cfgs.target}_{i}.svg"
-        png_path = f"{cfgs.png_dir}/{cfgs.target}_{i}.png"
+    try:
+        _, iterations = await run_pipeline(cfgs, session)
+    finally:
+        await session.aclose()
 
     # Automatically select the best SVG
     print("======== Selecting the best SVG using ImageReward or CLIP ========")
-    select_best_svg(cfgs, model_name=cfgs.reward_model)
+    select_best_svg(cfgs, iterations, model_name=cfgs.reward_model)
     print("Done!")
 
 
 if __name__ == "__main__":
     cfg = parse_arguments()
-    main(cfg)
+    asyncio.run(main(cfg))
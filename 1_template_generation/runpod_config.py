@@ -4,8 +4,34 @@ Contains configuration helpers and utilities for RunPod deployment
 """
 
 import os
+import sys
+import json
+import hashlib
+import platform
+import traceback
+from types import MappingProxyType
 from typing import Dict, Any
 
+__all__ = [
+    "RunPodConfig",
+    "check_environment",
+    "format_error_response",
+    "format_validation_error",
+    "get_system_info",
+    "clear_cuda_cache",
+]
+
+# torch module, imported on the first `get_system_info` call (False if missing)
+_torch = None
+
+# Environment variables reported by `check_environment`
+REQUIRED_ENV_VARS = ("ANTHROPIC_API_KEY", "BACKEND")
+OPTIONAL_ENV_VARS = ("OPENAI_API_KEY",)
+
+# CUDA probe results persisted across worker restarts
+CUDA_CACHE_PATH = os.path.expanduser("~/.chat2svg_cuda_cache.json")
+_CUDA_FIELDS = ("cuda_available", "cuda_version", "device_count", "device_name", "device_capability")
+
 
 class RunPodConfig:
     """Configuration class for RunPod serverless deployment"""
@@ -16,6 +42,7 @@ class RunPodConfig:
     DEFAULT_VIEWBOX = 512
     DEFAULT_REFINE_ITER = 2
     DEFAULT_PROMPTS_FILE = "prompts"
+    DEFAULT_PARALLEL_CANDIDATES = False
     
     # RunPod specific settings
     TIMEOUT_SECONDS = 600  # 10 minutes timeout for generation
@@ -25,8 +52,20 @@ class RunPodConfig:
     PRELOAD_REWARD_MODEL = True  # Preload reward model on startup
     PRELOAD_CLIP_MODEL = False  # Set to True if using CLIP primarily
     
-    @staticmethod
-    def validate_input(job_input: Dict[str, Any]) -> tuple[bool, str]:
+    # Built once instead of on every request
+    _ALLOWED_REWARD_MODELS = frozenset(("ImageReward", "CLIP"))
+    _DEFAULTS = MappingProxyType({
+        "model": DEFAULT_MODEL,
+        "reward_model": DEFAULT_REWARD_MODEL,
+        "viewbox": DEFAULT_VIEWBOX,
+        "refine_iter": DEFAULT_REFINE_ITER,
+        "prompts_file": DEFAULT_PROMPTS_FILE,
+        "parallel_candidates": DEFAULT_PARALLEL_CANDIDATES,
+        "target": "generated"
+    })
+    
+    @classmethod
+    def validate_input(cls, job_input: Dict[str, Any]) -> tuple[bool, str]:
         """
         Validate input parameters
         
@@ -36,52 +75,57 @@ class RunPodConfig:
         Returns:
             Tuple of (is_valid, error_message)
         """
+        # Cheapest checks first; the prompt text is only inspected once
+        # every other parameter is known to be valid
+        
         # Check required parameters
         if "prompt" not in job_input:
             return False, "Missing required parameter: prompt"
         
-        # Validate prompt is not empty
-        if not job_input["prompt"].strip():
-            return False, "Parameter 'prompt' cannot be empty"
-        
         # Validate reward model if provided
-        reward_model = job_input.get("reward_model", RunPodConfig.DEFAULT_REWARD_MODEL)
-        if reward_model not in ["ImageReward", "CLIP"]:
+        reward_model = job_input.get("reward_model", cls.DEFAULT_REWARD_MODEL)
+        # Check the type first: unhashable values cannot be looked up in the set
+        if type(reward_model) is not str or reward_model not in cls._ALLOWED_REWARD_MODELS:
             return False, f"Invalid reward_model: {reward_model}. Must be 'ImageReward' or 'CLIP'"
         
-        # Validate numeric parameters
-        viewbox = job_input.get("viewbox", RunPodConfig.DEFAULT_VIEWBOX)
-        if not isinstance(viewbox, int) or viewbox <= 0:
+        # Validate numeric parameters (exact type checks, so booleans are rejected)
+        viewbox = job_input.get("viewbox", cls.DEFAULT_VIEWBOX)
+        if type(viewbox) is not int or viewbox <= 0:
             return False, f"Invalid viewbox: {viewbox}. Must be a positive integer"
         
-        refine_iter = job_input.get("refine_iter", RunPodConfig.DEFAULT_REFINE_ITER)
-        if not isinstance(refine_iter, int) or refine_iter < 0:
+        refine_iter = job_input.get("refine_iter", cls.DEFAULT_REFINE_ITER)
+        if type(refine_iter) is not int or refine_iter < 0:
             return False, f"Invalid refine_iter: {refine_iter}. Must be a non-negative integer"
         
         if refine_iter > 10:
             return False, f"refine_iter too high: {refine_iter}. Maximum is 10 to prevent timeouts"
         
+        # Validate flags (strings such as "false" would otherwise be truthy)
+        parallel_candidates = job_input.get("parallel_candidates", cls.DEFAULT_PARALLEL_CANDIDATES)
+        if type(parallel_candidates) is not bool:
+            return False, f"Invalid parallel_candidates: {parallel_candidates}. Must be a boolean"
+        
+        # Validate prompt is a non-empty string
+        prompt = job_input["prompt"]
+        if type(prompt) is not str:
+            return False, "Parameter 'prompt' must be a string"
+        if not prompt or prompt.isspace():
+            return False, "Parameter 'prompt' cannot be empty"
+        
         return True, ""
     
-    @staticmethod
-    def get_default_params() -> Dict[str, Any]:
+    @classmethod
+    def get_default_params(cls) -> Dict[str, Any]:
         """
         Get default parameters for SVG generation
         
         Returns:
             Dictionary with default parameters
         """
-        return {
-            "model": RunPodConfig.DEFAULT_MODEL,
-            "reward_model": RunPodConfig.DEFAULT_REWARD_MODEL,
-            "viewbox": RunPodConfig.DEFAULT_VIEWBOX,
-            "refine_iter": RunPodConfig.DEFAULT_REFINE_ITER,
-            "prompts_file": RunPodConfig.DEFAULT_PROMPTS_FILE,
-            "target": "generated"
-        }
-    
-    @staticmethod
-    def merge_with_defaults(job_input: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(cls._DEFAULTS)
+    
+    @classmethod
+    def merge_with_defaults(cls, job_input: Dict[str, Any]) -> Dict[str, Any]:
         """
         Merge user input with default parameters
         
@@ -91,9 +135,7 @@ class RunPodConfig:
         Returns:
             Complete parameter dictionary
         """
-        defaults = RunPodConfig.get_default_params()
-        defaults.update(job_input)
-        return defaults
+        return {**cls._DEFAULTS, **job_input}
 
 
 def check_environment() -> Dict[str, Any]:
@@ -103,30 +145,15 @@ def check_environment() -> Dict[str, Any]:
     Returns:
         Dictionary with environment status
     """
-    required_vars = ["ANTHROPIC_API_KEY", "BACKEND"]
-    optional_vars = ["OPENAI_API_KEY"]
-    
-    status = {
-        "all_required_set": True,
-        "missing_required": [],
-        "optional_set": {},
-        "backend": None
-    }
-    
-    # Check required variables
-    for var in required_vars:
-        if not os.getenv(var):
-            status["all_required_set"] = False
-            status["missing_required"].append(var)
-    
-    # Check optional variables
-    for var in optional_vars:
-        status["optional_set"][var] = os.getenv(var) is not None
+    env = os.environ
+    missing_required = [var for var in REQUIRED_ENV_VARS if not env.get(var)]
     
-    # Get backend
-    status["backend"] = os.getenv("BACKEND")
-    
-    return status
+    return {
+        "all_required_set": not missing_required,
+        "missing_required": missing_required,
+        "optional_set": {var: var in env for var in OPTIONAL_ENV_VARS},
+        "backend": env.get("BACKEND")
+    }
 
 
 def format_error_response(error: Exception, context: str = "") -> Dict[str, Any]:
@@ -140,42 +167,141 @@ def format_error_response(error: Exception, context: str = "") -> Dict[str, Any]
     Returns:
         Formatted error dictionary
     """
-    import traceback
-    
-    return {
+    response = {
         "success": False,
         "error": str(error),
         "error_type": type(error).__name__,
         "context": context,
-        "traceback": traceback.format_exc()
     }
+    
+    # Only format a traceback while an exception is being handled
+    exc_info = sys.exc_info()
+    if exc_info[0] is not None:
+        response["traceback"] = "".join(traceback.format_exception(*exc_info))
+    
+    return response
+
+
+def format_validation_error(message: str) -> Dict[str, Any]:
+    """
+    Format a `validate_input` failure for RunPod
+    
+    Args:
+        message: Error message returned by the validation
+        
+    Returns:
+        Formatted error dictionary, without a traceback
+    """
+    return {
+        "success": False,
+        "error": message,
+        "error_type": "ValidationError",
+        "context": "input validation",
+    }
+
+
+def _cuda_fingerprint() -> str:
+    """Key identifying the machine and the GPUs visible to this process"""
+    system = platform.platform() + platform.machine() + os.environ.get("CUDA_VISIBLE_DEVICES", "")
+    return hashlib.blake2b(system.encode()).hexdigest()[:16]
+
+
+def _load_cuda_cache() -> Dict[str, Any] | None:
+    """
+    Load the CUDA probe results cached for this system
+    
+    Returns:
+        Dictionary with the cached CUDA fields, or None if missing or stale
+    """
+    try:
+        with open(CUDA_CACHE_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get("key") != _cuda_fingerprint():
+        return None
+    
+    info = cache.get("info", {})
+    if "device_capability" in info:
+        info["device_capability"] = tuple(info["device_capability"])
+    return info
+
+
+def _save_cuda_cache(info: Dict[str, Any]) -> None:
+    """Persist the CUDA fields of `info` for later worker starts"""
+    cache = {
+        "key": _cuda_fingerprint(),
+        "info": {k: info[k] for k in _CUDA_FIELDS if k in info},
+    }
+    try:
+        with open(CUDA_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        pass
+
+
+def clear_cuda_cache() -> None:
+    """Remove the on-disk CUDA detection cache and the in-process results"""
+    _SYSTEM_INFO.clear()
+    try:
+        os.remove(CUDA_CACHE_PATH)
+    except FileNotFoundError:
+        pass
+
+
+# Populated on first call; the CUDA probes do not change within a process
+_SYSTEM_INFO: Dict[str, Any] = {}
 
 
 def get_system_info() -> Dict[str, Any]:
     """
     Get system information for debugging
     
+    CUDA detection is cached on disk (see `CUDA_CACHE_PATH`), so torch is
+    only imported when the cache is missing or `CUDA_VISIBLE_DEVICES` changed.
+    
     Returns:
         Dictionary with system info
     """
-    import torch
-    import sys
-    
-    info = {
-        "python_version": sys.version,
-        "cuda_available": torch.cuda.is_available(),
-        "cuda_version": torch.version.cuda if torch.cuda.is_available() else None,
-        "device_count": torch.cuda.device_count() if torch.cuda.is_available() else 0,
-    }
+    global _torch
     
-    if torch.cuda.is_available():
-        info["device_name"] = torch.cuda.get_device_name(0)
-        info["device_capability"] = torch.cuda.get_device_capability(0)
+    if not _SYSTEM_INFO:
+        info = {"python_version": sys.version}
+        
+        cached = _load_cuda_cache()
+        if cached is not None:
+            info.update(cached)
+        else:
+            if _torch is None:
+                try:
+                    import torch as _torch
+                except ImportError:
+                    _torch = False
+            
+            cuda_ok = bool(_torch) and _torch.cuda.is_available()
+            info["cuda_available"] = cuda_ok
+            info["cuda_version"] = _torch.version.cuda if cuda_ok else None
+            info["device_count"] = _torch.cuda.device_count() if cuda_ok else 0
+            
+            if cuda_ok:
+                info["device_name"] = _torch.cuda.get_device_name(0)
+                info["device_capability"] = _torch.cuda.get_device_capability(0)
+            
+            # A missing torch install is not a property of the machine
+            if _torch:
+                _save_cuda_cache(info)
+        
+        _SYSTEM_INFO.update(info)
     
-    return info
+    return _SYSTEM_INFO.copy()
 
 
 if __name__ == "__main__":
+    if "--clear-cuda-cache" in sys.argv:
+        clear_cuda_cache()
+        print(f"Removed CUDA detection cache: {CUDA_CACHE_PATH}")
+        sys.exit(0)
+    
     # Test configuration
     print("RunPod Configuration Test")
     print("=" * 50)
@@ -4,6 +4,7 @@ Simula una request de RunPod para testing local
 """
 
 import sys
+import asyncio
 sys.path.append('..')
 
 from handler import handler
@@ -11,10 +12,16 @@ import json
 from pathlib import Path
 import base64
 
+# Carpeta de resultados y serializador reutilizados por todos los tests
+OUT = Path("test_output")
+_dumps = json.JSONEncoder(indent=2).encode
+
 
 def test_handler():
     """Prueba el handler con diferentes casos"""
     
+    OUT.mkdir(exist_ok=True)
+    
     print("🧪 Testing RunPod Handler Locally\n")
     print("=" * 60)
     
@@ -30,11 +37,11 @@ def test_handler():
         }
     }
     
-    print(f"Input: {json.dumps(test_event_1, indent=2)}")
+    print(f"Input: {_dumps(test_event_1)}")
     print("\n⏳ Procesando...")
     
     try:
-        result = handler(test_event_1)
+        result = asyncio.run(handler(test_event_1))
         
         if result.get("success"):
             print("✅ SUCCESS!")
@@ -42,19 +49,14 @@ def test_handler():
             for key, value in result["metadata"].items():
                 print(f"  - {key}: {value}")
             
-            # Guardar resultados
-            output_dir = Path("test_output")
-            output_dir.mkdir(exist_ok=True)
-            
             # Guardar SVG
-            svg_path = output_dir / "test_cat.svg"
+            svg_path = OUT / "test_cat.svg"
             svg_path.write_text(result["best_svg"])
             print(f"\n💾 SVG guardado en: {svg_path}")
             
             # Guardar PNG
-            png_path = output_dir / "test_cat.png"
-            png_data = base64.b64decode(result["best_png_base64"])
-            png_path.write_bytes(png_data)
+            png_path = OUT / "test_cat.png"
+            png_path.write_bytes(base64.b64decode(result["best_png_base64"]))
             print(f"💾 PNG guardado en: {png_path}")
             
             print(f"\n📈 Iteraciones generadas: {len(result['all_iterations'])}")
@@ -82,19 +84,18 @@ def test_handler():
         }
     }
     
-    print(f"Input: {json.dumps(test_event_2, indent=2)}")
+    print(f"Input: {_dumps(test_event_2)}")
     print("\n⏳ Procesando...")
     
     try:
-        result = handler(test_event_2)
+        result = asyncio.run(handler(test_event_2))
         
         if result.get("success"):
             print("✅ SUCCESS!")
             print(f"Mejor iteración: {result['best_index']}")
             
             # Guardar
-            output_dir = Path("test_output")
-            svg_path = output_dir / "test_rocket.svg"
+            svg_path = OUT / "test_rocket.svg"
             svg_path.write_text(result["best_svg"])
             print(f"💾 SVG guardado en: {svg_path}")
         else:
@@ -113,10 +114,10 @@ def test_handler():
         }
     }
     
-    print(f"Input: {json.dumps(test_event_3, indent=2)}")
+    print(f"Input: {_dumps(test_event_3)}")
     
     try:
-        result = handler(test_event_3)
+        result = asyncio.run(handler(test_event_3))
         
         if result.get("success"):
             print("❌ Se esperaba un error pero fue exitoso!")
@@ -1,8 +1,18 @@
 import os
+import copy
+import json
+import asyncio
+import itertools
 import yaml
 import base64
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import closing
 import mimetypes
 import requests
+import httpx
 from dotenv import load_dotenv
 from utils.util import read
 
@@ -16,18 +26,48 @@ assert backend in [
     "Wildcard",
 ], f"Invalid backend: {backend}. Choose either 'Claude' or 'Wildcard'."
 
+# Responses of cached tasks are kept here across runs, keyed by the request payload
+PROMPT_CACHE_PATH = os.path.expanduser("~/.cache/chat2svg/prompt_cache.db")
+# Most recently used responses, also kept in memory; read from worker threads
+MEMORY_CACHE_SIZE = 256
+_memory_cache: OrderedDict[str, str] = OrderedDict()
+_memory_lock = threading.Lock()
+
 
 class Session:
+    # Tasks whose responses are reused for an identical request. SVG generation
+    # and refinement are left out because their sampled variety is wanted.
+    cached_tasks: tuple[str, ...] = ("expand_text_prompt",)
+
     def __init__(self, model, prompts_file) -> None:
         self.model = model
+        self.prompts_file = prompts_file
         self.past_tasks: list[str] = []
         self.past_messages = []
         self.past_responses: list[str] = []
+        # Sampling temperature sent with every request; None keeps the provider default
+        self.temperature: float | None = None
+
+        # Keep-alive HTTP clients reused by every request of the session and its forks
+        self._http = requests.Session()
+        self._client: httpx.AsyncClient | None = None
+        # When set, `asend` requests are queued into provider-side message batches
+        self.batcher: MessageBatcher | None = None
 
         # Load the predefined prompts for the LLM
         with open(f"../{prompts_file}.yaml") as file:
             self.predefined_prompts: dict[str, str] = yaml.safe_load(file)
 
+    def fork(self) -> "Session":
+        """Returns an independent session that continues from the current conversation."""
+        # Open the pool first so forks share it and the parent's `aclose` releases it
+        self._async_client()
+        forked = copy.copy(self)
+        forked.past_tasks = list(self.past_tasks)
+        forked.past_messages = list(self.past_messages)
+        forked.past_responses = list(self.past_responses)
+        return forked
+
     def send(
         self,
         task: str,
@@ -64,45 +104,87 @@ class Session:
 
         return prompt
 
+    async def asend(
+        self,
+        task: str,
+        prompt_info: dict[str, str] | None = None,
+        images: list[str] = [],
+        file_path=None,
+    ) -> str:
+        """Same as `send`, but awaits the LLM round trip instead of blocking on it."""
+        print(f"$ --- Sending task: {task}")
+        self.past_tasks.append(task)
+        prompt = self._make_prompt(task, prompt_info)
+        await self._asend(prompt, images, file_path)
+        response = self.past_responses[-1]
+        print(f"$ --- Response:\n{response}\n")
+
+        return response
+
     def _send(self, prompt: str, images: list[str] = [], file_path=None) -> str:
         payload = self._create_payload(prompt, images=images)
         if not os.path.exists(file_path):
-            # ANTROPICS
-            if backend == "Claude":
-                headers = {
-                    "Content-Type": "application/json",
-                    "x-api-key": api_key,
-                    "anthropic-version": "2023-06-01",  # TODO use if antropics
-                }
-                response = requests.post(
-                    "https://api.anthropic.com/v1/messages",
-                    headers=headers,
-                    json=payload,
-                )  # Anthropic
-            # WILDCARD
-            elif backend == "Wildcard":
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}",
-                }
-                response = requests.post(
-                    "https://api.gptsapi.net/v1/chat/completions",
-                    headers=headers,
-                    json=payload,
-                )  # WildCard
-            try:
-                if backend == "Claude":
-                    response = response.json()["content"][0]["text"]  # antropics
-                elif backend == "Wildcard":
-                    response = response.json()["choices"][0]["message"]["content"]
-            except:
-                print(f"$ --- Error Response: {response.json()}\n")
+            key = self._cache_key(payload)
+            response = _cache_get(key) if key else None
+            if response is None:
+                url, headers = _endpoint()
+                response = self._http.post(url, headers=headers, json=payload)
+                response = _parse_response(response)
+                if key and isinstance(response, str):
+                    _cache_put(key, response)
         else:
             print(f"$ --- Reading from file: {file_path}")
             response = read(file_path)
         self.past_messages.append({"role": "assistant", "content": response})
         self.past_responses.append(response)
 
+    async def _asend(self, prompt: str, images: list[str] = [], file_path=None) -> str:
+        payload = self._create_payload(prompt, images=images)
+        if not os.path.exists(file_path):
+            key = self._cache_key(payload)
+            response = await asyncio.to_thread(_cache_get, key) if key else None
+            if response is None:
+                if self.batcher is not None:
+                    response = await self.batcher.submit(payload)
+                else:
+                    url, headers = _endpoint()
+                    client = self._async_client()
+                    response = await client.post(url, headers=headers, json=payload)
+                    response = _parse_response(response)
+                if key and isinstance(response, str):
+                    await asyncio.to_thread(_cache_put, key, response)
+        else:
+            print(f"$ --- Reading from file: {file_path}")
+            response = read(file_path)
+        self.past_messages.append({"role": "assistant", "content": response})
+        self.past_responses.append(response)
+
+    def _async_client(self) -> httpx.AsyncClient:
+        # HTTP/2 lets concurrent requests (e.g. forked candidates) share one connection
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                timeout=None,  # LLM responses routinely take longer than httpx's 5 s default
+                limits=httpx.Limits(max_connections=64),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        """Closes the connection pool used by `asend`; it is reopened on the next call."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _cache_key(self, payload) -> str | None:
+        """Returns the prompt cache key for the current task, or None if it is not cached."""
+        task = self.past_tasks[-1]
+        if task not in self.cached_tasks:
+            return None
+        request = json.dumps(payload, sort_keys=True)
+        return hashlib.sha256(
+            f"{self.model}|{self.prompts_file}|{task}|{request}".encode()
+        ).hexdigest()
+
     def _create_payload(self, prompt: str, images: list[str] = []):
         """Creates the payload for the API request."""
         messages = {
@@ -144,9 +226,153 @@ class Session:
         }
         if backend == "Claude":
             payload["max_tokens"] = 5000
+        if self.temperature is not None:
+            payload["temperature"] = self.temperature
         return payload
 
 
+class MessageBatcher:
+    """
+    Groups concurrent `Session.asend` requests into Anthropic Message Batches,
+    which are billed at half the price of individual requests.
+
+    Requests are collected until none has arrived for `collect_window` seconds,
+    submitted as one batch, and the batch is polled every `poll_interval`
+    seconds until its results can be handed back to the waiting sessions.
+    """
+
+    BATCHES_URL = "https://api.anthropic.com/v1/messages/batches"
+
+    def __init__(self, collect_window: float = 2.0, poll_interval: float = 30.0) -> None:
+        if backend != "Claude":
+            raise ValueError(f"Message batches are not supported by the {backend} backend")
+        self.collect_window = collect_window
+        self.poll_interval = poll_interval
+        self._pending: list[tuple[str, dict, asyncio.Future]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._last_submit = 0.0
+        self._ids = itertools.count()
+
+    async def submit(self, payload: dict) -> str:
+        """Queues a request payload and returns the text of its response."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((f"request-{next(self._ids)}", payload, future))
+        self._last_submit = loop.time()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        while (delay := self._last_submit + self.collect_window - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        batch, self._pending, self._flush_task = self._pending, [], None
+
+        try:
+            results = await self._run_batch(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for custom_id, _, future in batch:
+            result = results.get(custom_id, {"type": "missing"})
+            if result["type"] == "succeeded":
+                future.set_result(result["message"]["content"][0]["text"])
+            else:
+                future.set_exception(RuntimeError(f"Batch request {custom_id} failed: {result}"))
+
+    async def _run_batch(self, batch) -> dict[str, dict]:
+        _, headers = _endpoint()
+        requests_ = [{"custom_id": custom_id, "params": payload} for custom_id, payload, _ in batch]
+        async with httpx.AsyncClient(timeout=None) as client:
+            response = await client.post(self.BATCHES_URL, headers=headers, json={"requests": requests_})
+            response.raise_for_status()
+            info = response.json()
+            print(f"$ --- Submitted batch {info['id']} with {len(batch)} requests")
+            while info["processing_status"] != "ended":
+                await asyncio.sleep(self.poll_interval)
+                response = await client.get(f"{self.BATCHES_URL}/{info['id']}", headers=headers)
+                response.raise_for_status()
+                info = response.json()
+            response = await client.get(info["results_url"], headers=headers)
+            response.raise_for_status()
+
+        results = {}
+        for line in response.text.splitlines():
+            if line.strip():
+                item = json.loads(line)
+                results[item["custom_id"]] = item["result"]
+        return results
+
+
+def _endpoint() -> tuple[str, dict[str, str]]:
+    """Returns the URL and headers for the configured backend."""
+    # ANTROPICS
+    if backend == "Claude":
+        headers = {
+            "Content-Type": "application/json",
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",  # TODO use if antropics
+        }
+        return "https://api.anthropic.com/v1/messages", headers  # Anthropic
+    # WILDCARD
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+    return "https://api.gptsapi.net/v1/chat/completions", headers  # WildCard
+
+
+def _parse_response(response):
+    """Extracts the message text from a `requests` or `httpx` response."""
+    try:
+        if backend == "Claude":
+            return response.json()["content"][0]["text"]  # antropics
+        elif backend == "Wildcard":
+            return response.json()["choices"][0]["message"]["content"]
+    except:
+        print(f"$ --- Error Response: {response.json()}\n")
+    return response
+
+
+def _memory_get(key: str) -> str | None:
+    with _memory_lock:
+        response = _memory_cache.get(key)
+        if response is not None:
+            _memory_cache.move_to_end(key)
+        return response
+
+
+def _memory_put(key: str, response: str):
+    with _memory_lock:
+        _memory_cache[key] = response
+        _memory_cache.move_to_end(key)
+        if len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _cache_get(key: str) -> str | None:
+    response = _memory_get(key)
+    if response is None and os.path.exists(PROMPT_CACHE_PATH):
+        with closing(sqlite3.connect(PROMPT_CACHE_PATH)) as db:
+            row = db.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            response = row[0]
+            _memory_put(key, response)
+    if response is not None:
+        print("$ --- Reusing cached response")
+    return response
+
+
+def _cache_put(key: str, response: str):
+    _memory_put(key, response)
+    os.makedirs(os.path.dirname(PROMPT_CACHE_PATH), exist_ok=True)
+    with closing(sqlite3.connect(PROMPT_CACHE_PATH)) as db, db:
+        db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT)")
+        db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)", (key, response))
+
+
 def encode_image(image_path: str):
     """Encodes an image to base64 and determines the correct MIME type."""
     mime_type, _ = mimetypes.guess_type(image_path)
@@ -0,0 +1,99 @@
+"""
+Stage 1 LLM pipeline shared by the CLI, the API wrapper and the RunPod handler
+"""
+
+import asyncio
+from utils.util import asave, asave_svg
+
+# Temperature range spread across parallel candidates, most to least exploratory
+CANDIDATE_TEMPERATURES = (1.0, 0.5)
+
+
+async def run_pipeline(cfg, session, limiter=None):
+    """
+    Expand the prompt, write the SVG code and produce `refine_iter + 1` candidates
+
+    Args:
+        cfg: Configuration with `prompt`, `target`, `refine_iter`, `viewbox`,
+            `parallel_candidates` and the `svg_dir` / `png_dir` / `msg_dir` folders
+        session: `gpt.Session` used for every task
+        limiter: Optional async context manager bounding concurrent LLM requests
+
+    Returns:
+        Tuple of (expanded prompt, list of iteration dicts with their paths)
+    """
+    prompt_path = f"{cfg.msg_dir}/{cfg.target}_prompt"
+    iterations = [
+        {
+            "iteration": i,
+            "msg_path": f"{cfg.msg_dir}/{cfg.target}_raw{i}",
+            "svg_path": f"{cfg.svg_dir}/{cfg.target}_{i}.svg",
+            "png_path": f"{cfg.png_dir}/{cfg.target}_{i}.png",
+        }
+        for i in range(cfg.refine_iter + 1)
+    ]
+
+    async def send(*args, session=session, **kwargs):
+        if limiter is None:
+            return await session.asend(*args, **kwargs)
+        async with limiter:
+            return await session.asend(*args, **kwargs)
+
+    # Task 1: Expand the Text Prompt
+    print(f"Expanding prompt: {cfg.prompt}")
+    expanded_text_prompt = await send(
+        "expand_text_prompt", {"text_prompt": cfg.prompt}, file_path=prompt_path
+    )
+
+    if cfg.parallel_candidates:
+        # Task 2: Generate independent SVG candidates from forks of the
+        # same conversation, each sampled at its own temperature so the
+        # variants differ. Each candidate is rendered as soon as its own
+        # response arrives, overlapping with the LLM calls still in flight.
+        high, low = CANDIDATE_TEMPERATURES
+        step = (high - low) / max(len(iterations) - 1, 1)
+
+        async def candidate(it):
+            fork = session.fork()
+            fork.temperature = round(high - step * it["iteration"], 2)
+            svg_code = await send(
+                "write_svg_code", session=fork, file_path=it["msg_path"]
+            )
+            await asyncio.gather(
+                asave(it["msg_path"], svg_code),
+                asave_svg(cfg, svg_code, f"{cfg.target}_{it['iteration']}"),
+            )
+
+        print(f"Generating {len(iterations)} SVG candidates...")
+        await asyncio.gather(
+            asave(prompt_path, expanded_text_prompt),
+            *[candidate(it) for it in iterations],
+        )
+        return expanded_text_prompt, iterations
+
+    # Task 2: Generate SVG Code (the prompt log is written meanwhile)
+    print("Generating initial SVG...")
+    svg_code, _ = await asyncio.gather(
+        send("write_svg_code", file_path=iterations[0]["msg_path"]),
+        asave(prompt_path, expanded_text_prompt),
+    )
+
+    # Task 3: Iterate Improvement
+    # Each refinement needs the PNG of the previous one, so rendering stays
+    # on the critical path; the raw log write overlaps the next LLM call.
+    for i, it in enumerate(iterations):
+        if i > 0:
+            print(f"Refining SVG iteration {i}/{cfg.refine_iter}...")
+            svg_code, _ = await asyncio.gather(
+                send(
+                    "svg_refine",
+                    images=[iterations[i - 1]["png_path"]],
+                    file_path=it["msg_path"],
+                ),
+                pending_log,
+            )
+        await asave_svg(cfg, svg_code, f"{cfg.target}_{i}")
+        pending_log = asave(it["msg_path"], svg_code)
+    await pending_log
+
+    return expanded_text_prompt, iterations
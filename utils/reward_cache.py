@@ -0,0 +1,186 @@
+"""
+Per-process cache of the reward models used to rank SVG candidates
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+_MODEL_CACHE: dict[str, object] = {}
+# Serializes loading, so concurrent callers never load the same model twice
+_LOAD_LOCK = threading.Lock()
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU mapping, used to bound per-prompt feature caches
+
+    Args:
+        maxsize: Number of entries kept before the least recently used is dropped
+    """
+
+    def __init__(self, maxsize: int = 32) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def get_model(name: str):
+    """
+    Load a reward model on first use and keep it resident for the process
+
+    Args:
+        name: "ImageReward" or "CLIP"
+
+    Returns:
+        The ImageReward model, or a (model, preprocess) tuple for CLIP
+    """
+    model = _MODEL_CACHE.get(name)
+    if model is not None:
+        return model
+
+    with _LOAD_LOCK:
+        if name not in _MODEL_CACHE:
+            if name == "ImageReward":
+                import ImageReward as RM
+
+                _MODEL_CACHE[name] = RM.load("ImageReward-v1.0")
+            elif name == "CLIP":
+                import torch
+                import clip
+
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+                _MODEL_CACHE[name] = clip.load("ViT-B/32", device=device)
+            else:
+                raise ValueError(f"Unknown reward model: {name}")
+        return _MODEL_CACHE[name]
+
+
+def release_model(name: str) -> None:
+    """
+    Drop a cached reward model and hand its GPU memory back to the driver
+
+    Args:
+        name: "ImageReward" or "CLIP"
+    """
+    if _MODEL_CACHE.pop(name, None) is not None:
+        import gc
+        import torch
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def image_reward_scores(model, prompt: str, png_files: list[str]):
+    """
+    Score all candidates with ImageReward in a single batched forward pass
+
+    Args:
+        model: Model returned by `get_model("ImageReward")`
+        prompt: Text prompt the candidates should match
+        png_files: Paths of the candidate renders
+
+    Returns:
+        1-D tensor with one reward per PNG, in the order of `png_files`
+    """
+    import torch
+    from PIL import Image
+
+    if not all(hasattr(model, attr) for attr in ("blip", "mlp", "preprocess")):
+        # Unknown ImageReward version; fall back to its per-image loop
+        _, rewards = model.inference_rank(prompt, png_files)
+        return torch.tensor(rewards).reshape(-1)
+
+    # Same computation as `ImageReward.inference_rank`, batched over the images
+    max_workers = max(1, min(len(png_files), os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        images = list(ex.map(lambda p: model.preprocess(Image.open(p)), png_files))
+    images = torch.stack(images).to(model.device)
+
+    text_input = model.blip.tokenizer(
+        prompt, padding="max_length", truncation=True, max_length=35, return_tensors="pt"
+    ).to(model.device)
+    n = len(png_files)
+
+    image_embeds = model.blip.visual_encoder(images)
+    image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=model.device)
+    text_output = model.blip.text_encoder(
+        text_input.input_ids.expand(n, -1),
+        attention_mask=text_input.attention_mask.expand(n, -1),
+        encoder_hidden_states=image_embeds,
+        encoder_attention_mask=image_atts,
+        return_dict=True,
+    )
+    rewards = model.mlp(text_output.last_hidden_state[:, 0, :].float())
+    rewards = (rewards - model.mean) / model.std
+    return rewards.reshape(-1)
+
+
+def clip_scores(model, preprocess, prompt: str, png_files: list[str], text_cache: LRUCache):
+    """
+    Score all candidates by CLIP cosine similarity with the prompt
+
+    Args:
+        model: CLIP model returned by `get_model("CLIP")`
+        preprocess: Matching preprocess transform returned by `get_model("CLIP")`
+        prompt: Text prompt the candidates should match
+        png_files: Paths of the candidate renders
+        text_cache: `LRUCache` keeping the normalized text features of recent prompts
+
+    Returns:
+        1-D tensor with one score per PNG, in the order of `png_files`
+    """
+    import torch
+    import clip
+    from PIL import Image
+
+    device = next(model.parameters()).device
+
+    # Decode and preprocess in parallel (PIL releases the GIL), then stack once
+    max_workers = max(1, min(len(png_files), os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        images = torch.stack(list(ex.map(lambda p: preprocess(Image.open(p)), png_files)))
+    if device.type == "cuda":
+        images = images.pin_memory()
+    images = images.to(device, non_blocking=True)
+
+    # fp16 is ample for ranking; CLIP already holds fp16 weights on CUDA
+    with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == "cuda"):
+        n = images.shape[0]
+        if getattr(model, "_visual_compiled", False):
+            # Pad to a power-of-two batch so only a few shapes are ever compiled
+            padded = 1 << (n - 1).bit_length()
+            padding = images[-1:].expand(padded - n, *images.shape[1:])
+            images = torch.cat([images, padding])
+        image_features = model.encode_image(images)[:n]
+
+        key = ("ViT-B/32", prompt)
+        text_features = text_cache.get(key)
+        if text_features is None:
+            text = clip.tokenize([prompt]).to(device)
+            text_features = model.encode_text(text)
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+            text_cache[key] = text_features
+
+    # Cosine similarity with the unit-norm text feature, dividing the dot
+    # products by the image norms rather than normalizing the features first
+    return (image_features @ text_features.T).squeeze(-1) / image_features.norm(dim=-1)
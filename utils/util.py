@@ -1,7 +1,14 @@
 import os
 import time
+import asyncio
+import aiofiles
 import cairosvg
 
+try:
+    import resvg_py  # Rust rasterizer, much faster than CairoSVG
+except ImportError:
+    resvg_py = None
+
 
 def save(path, content):
     with open(path, "w") as f:
@@ -13,7 +20,39 @@ def save_svg(cfg, svg_code, svg_id):
     png_path = f"{cfg.png_dir}/{svg_id}.png"
     svg_code = extract_svg(svg_code)
     save(svg_path, svg_code)
-    cairosvg.svg2png(url=svg_path, write_to=png_path, background_color="white")
+    rasterize(svg_code, svg_path, png_path, cfg.viewbox)
+
+
+async def asave(path, content):
+    async with aiofiles.open(path, "w") as f:
+        await f.write(content)
+
+
+async def asave_svg(cfg, svg_code, svg_id):
+    svg_path = f"{cfg.svg_dir}/{svg_id}.svg"
+    png_path = f"{cfg.png_dir}/{svg_id}.png"
+    svg_code = extract_svg(svg_code)
+    await asave(svg_path, svg_code)
+    await asyncio.to_thread(rasterize, svg_code, svg_path, png_path, cfg.viewbox)
+
+
+def rasterize(svg_code, svg_path, png_path, size):
+    # Render a `size` x `size` PNG on a white background, with resvg when
+    # available and CairoSVG otherwise; both backends give the same output size
+    if resvg_py is not None:
+        png = resvg_py.svg_to_bytes(
+            svg_string=svg_code, width=size, height=size, background="white"
+        )
+        with open(png_path, "wb") as f:
+            f.write(bytes(png))
+    else:
+        cairosvg.svg2png(
+            url=svg_path,
+            write_to=png_path,
+            output_width=size,
+            output_height=size,
+            background_color="white",
+        )
 
 
 def read(path):